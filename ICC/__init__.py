@@ -1,5 +1,5 @@
-from .icc import icc
+from .icc import icc, icc_batch, make_icc
 
 from ._version import __version__
 
-__all__ = ['icc', '__version__']
+__all__ = ['icc', 'icc_batch', 'make_icc', '__version__']
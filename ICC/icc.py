@@ -3,8 +3,275 @@
 Based on:
     https://www.rdocumentation.org/packages/irr/versions/0.84.1/topics/icc
 """
+import functools
+
 import numpy as np
-from scipy.stats import f
+from numba import njit, prange
+from scipy.special import betainc, betaincinv
+
+# Integer codes of the ICC configurations used inside the jitted kernels
+_MODELS = {'oneway': 0, 'twoway': 1}
+_TYPES = {'consistency': 0, 'agreement': 1}
+_UNITS = {'single': 0, 'average': 1}
+
+_CONFIGS = {('oneway', 'agreement', 'single'),
+            ('twoway', 'agreement', 'single'),
+            ('twoway', 'consistency', 'single'),
+            ('oneway', 'agreement', 'average'),
+            ('twoway', 'agreement', 'average'),
+            ('twoway', 'consistency', 'average'), }
+
+
+def _check_config(model, type, unit):
+    if (model, type, unit) not in _CONFIGS:
+        raise ValueError('Using not implemented configuration.')
+
+
+def _check_shape(n_subjects, n_raters):
+    if n_subjects < 2:
+        raise ValueError('Using one subject only. Add more subjects to calculate ICC.')
+    if n_raters < 2:
+        raise ValueError('Using one rater only. Add more raters to calculate ICC.')
+
+
+def _as_ratings(ratings, ndim):
+    """Convert the ratings to a C-contiguous float64 array of ndim dimensions.
+
+    The jitted kernels then always see the same dense layout, and are not compiled
+    again for every dtype or memory layout of the input.
+    """
+    ratings = np.ascontiguousarray(ratings, dtype=np.float64)
+    if ratings.ndim != ndim:
+        raise ValueError('Expected ratings with {} dimensions, got {}.'.format(ndim, ratings.ndim))
+    _check_shape(*ratings.shape[-2:])
+    return ratings
+
+
+def _f_sf_uncached(x, dfn, dfd):
+    # Survival function of the F distribution through the regularized incomplete
+    # beta function, which avoids importing scipy.stats and its rv_continuous dispatch.
+    dfn = np.asarray(dfn, dtype=np.float64)
+    dfd = np.asarray(dfd, dtype=np.float64)
+    x = np.maximum(x, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sf = betainc(dfd / 2, dfn / 2, dfd / (dfd + dfn * x))
+    return np.where((dfn > 0) & (dfd > 0), sf, np.nan)[()]
+
+
+def _f_ppf_uncached(q, dfn, dfd):
+    # Inverting the complement keeps the upper quantiles accurate for small dfd, where
+    # the beta quantile of q rounds to 1. y == 0 is the quantile at infinity.
+    dfn = np.asarray(dfn, dtype=np.float64)
+    dfd = np.asarray(dfd, dtype=np.float64)
+    y = betaincinv(dfd / 2, dfn / 2, 1 - q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ppf = dfd / dfn * (1 - y) / y
+    return np.where((dfn > 0) & (dfd > 0), ppf, np.nan)[()]
+
+
+@functools.lru_cache(maxsize=4096)
+def _f_ppf_cached(q, dfn, dfd):
+    return _f_ppf_uncached(q, dfn, dfd)
+
+
+def _f_sf(x, dfn, dfd):
+    """F survival function.
+
+    Not memoized, the F-values depend on the data and essentially never repeat.
+    """
+    return _f_sf_uncached(x, dfn, dfd)
+
+
+def _f_ppf(q, dfn, dfd):
+    """Memoized F percent point function.
+
+    The arguments are rounded so that floating point noise, e.g. in the
+    approximated degrees of freedom of the agreement ICCs, does not miss the cache.
+    The degrees of freedom keep 10 significant digits, as the approximated ones can be
+    far below 1. Array arguments are not hashable and are evaluated directly.
+    """
+    if np.ndim(q) or np.ndim(dfn) or np.ndim(dfd):
+        return _f_ppf_uncached(q, dfn, dfd)
+    return _f_ppf_cached(round(float(q), 12), float('{:.10g}'.format(dfn)), float('{:.10g}'.format(dfd)))
+
+
+@njit(cache=True)
+def _icc_moments(ratings):
+    """Compute the mean squares of the ANOVA decomposition of the ratings.
+
+    Returns
+    -------
+    MSr, MSw, MSc, MSe: float
+        The mean squares for rows, within rows, columns and error.
+    """
+    n_subjects, n_raters = ratings.shape
+    row_sum = np.zeros(n_subjects)
+    col_sum = np.zeros(n_raters)
+
+    # Welford's online update of the grand mean and the total sum of squares
+    count = 0
+    mean = 0.0
+    M2 = 0.0
+    for i in range(n_subjects):
+        for j in range(n_raters):
+            x = ratings[i, j]
+            row_sum[i] += x
+            col_sum[j] += x
+            count += 1
+            delta = x - mean
+            mean += delta / count
+            M2 += delta * (x - mean)
+
+    SSr = 0.0
+    for i in range(n_subjects):
+        d = row_sum[i] / n_raters - mean
+        SSr += d * d
+    SSr *= n_raters
+    SSc = 0.0
+    for j in range(n_raters):
+        d = col_sum[j] / n_subjects - mean
+        SSc += d * d
+    SSc *= n_subjects
+    # Differences of sums of squares, rounding can push them slightly below zero
+    SSe = max(M2 - SSr - SSc, 0.0)
+    SSw = max(M2 - SSr, 0.0)
+
+    MSr = SSr / (n_subjects - 1)
+    MSw = SSw / (n_subjects * (n_raters - 1))
+    MSc = SSc / (n_raters - 1)
+    MSe = SSe / ((n_subjects - 1) * (n_raters - 1))
+    return MSr, MSw, MSc, MSe
+
+
+@njit(cache=True, error_model='numpy')
+def _icc_stats(MSr, MSw, MSc, MSe, n_subjects, n_raters, model_id, type_id, unit_id):
+    """Compute the ICC and its F-statistic.
+
+    The mean squares can be floats or arrays of the same shape.
+
+    Returns
+    -------
+    coeff, Fvalue: float or array
+        The intraclass correlation coefficient and the F-statistic. The degrees of
+        freedom of the F-test are given by `_degrees_of_freedom`.
+    """
+    if model_id == 0:
+        # ICC(1,1) and ICC(1,k) One-Way Random, absolute
+        Fvalue = MSr / MSw
+        if unit_id == 0:
+            coeff = (MSr - MSw) / (MSr + (n_raters - 1) * MSw)
+        else:
+            coeff = (MSr - MSw) / MSr
+        return coeff, Fvalue
+
+    Fvalue = MSr / MSe
+    if type_id == 0:
+        # ICC(3,1) and ICC(3,k) Two-Way Mixed, consistency
+        if unit_id == 0:
+            coeff = (MSr - MSe) / (MSr + (n_raters - 1) * MSe)
+        else:
+            coeff = (MSr - MSe) / MSr
+        return coeff, Fvalue
+
+    # ICC(2,1) and ICC(2,k) Two-Way Random, absolute
+    if unit_id == 0:
+        coeff = (MSr - MSe) / (MSr + (n_raters - 1) * MSe + (n_raters / n_subjects) * (MSc - MSe))
+    else:
+        coeff = (MSr - MSe) / (MSr + (MSc - MSe) / n_subjects)
+    return coeff, Fvalue
+
+
+@njit(cache=True, error_model='numpy')
+def _icc_agreement_df(MSr, MSc, MSe, n_subjects, n_raters):
+    """Approximate the denominator degrees of freedom of the agreement confidence interval.
+
+    Returns
+    -------
+    v: float or array
+        The degrees of freedom of the F quantiles of ICC(2,1) and ICC(2,k).
+    """
+    icc2 = (MSr - MSe) / (MSr + (n_raters - 1) * MSe + (n_raters / n_subjects) * (MSc - MSe))
+    Fj = MSc / MSe
+    a = n_raters * icc2 * Fj
+    b = n_subjects * (1 + (n_raters - 1) * icc2) - n_raters * icc2
+    vn = (n_raters - 1) * (n_subjects - 1) * (a + b) * (a + b)
+    vd = (n_subjects - 1) * a * a + b * b
+    return vn / vd
+
+
+@njit(cache=True, error_model='numpy')
+def _icc_bounds(MSr, MSw, MSc, MSe, n_subjects, n_raters, model_id, type_id, unit_id, Fvalue, FL_crit, FU_crit):
+    """Compute the confidence interval of the ICC.
+
+    FL_crit and FU_crit are the F quantiles at the confidence level with (df1, df2)
+    and (df2, df1) degrees of freedom respectively, where df2 is replaced by the
+    approximated degrees of freedom for the agreement ICCs.
+
+    Returns
+    -------
+    lbound, ubound: float or array
+        The lower and upper bound of the confidence interval.
+    """
+    if model_id == 1 and type_id == 1:
+        lbound = (n_subjects * (MSr - FL_crit * MSe)) / (FL_crit * (
+                n_raters * MSc + (n_raters * n_subjects - n_raters - n_subjects) * MSe) + n_subjects * MSr)
+        ubound = (n_subjects * (FU_crit * MSr - MSe)) / (n_raters * MSc + (
+                n_raters * n_subjects - n_raters - n_subjects) * MSe + n_subjects * FU_crit * MSr)
+        if unit_id == 1:
+            lbound = lbound * n_raters / (1 + lbound * (n_raters - 1))
+            ubound = ubound * n_raters / (1 + ubound * (n_raters - 1))
+        return lbound, ubound
+
+    FL = Fvalue / FL_crit
+    FU = Fvalue * FU_crit
+    if unit_id == 0:
+        lbound = (FL - 1) / (FL + (n_raters - 1))
+        ubound = (FU - 1) / (FU + (n_raters - 1))
+    else:
+        lbound = 1 - 1 / FL
+        ubound = 1 - 1 / FU
+    return lbound, ubound
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _icc_batch_kernel(ratings, model_id, type_id, unit_id):
+    """Compute the mean squares, the ICC and the F-statistic of each matrix of a stack.
+
+    The matrices are independent, so the loop over the stack runs in parallel.
+
+    Returns
+    -------
+    MSr, MSw, MSc, MSe, coeff, Fvalue: array, shape (n_batch,)
+        See `_icc_moments` and `_icc_stats`.
+    """
+    n_batch, n_subjects, n_raters = ratings.shape
+    MSr = np.empty(n_batch)
+    MSw = np.empty(n_batch)
+    MSc = np.empty(n_batch)
+    MSe = np.empty(n_batch)
+    coeff = np.empty(n_batch)
+    Fvalue = np.empty(n_batch)
+    for b in prange(n_batch):
+        MSr_b, MSw_b, MSc_b, MSe_b = _icc_moments(ratings[b])
+        coeff_b, Fvalue_b = _icc_stats(MSr_b, MSw_b, MSc_b, MSe_b, n_subjects, n_raters,
+                                       model_id, type_id, unit_id)
+        MSr[b] = MSr_b
+        MSw[b] = MSw_b
+        MSc[b] = MSc_b
+        MSe[b] = MSe_b
+        coeff[b] = coeff_b
+        Fvalue[b] = Fvalue_b
+    return MSr, MSw, MSc, MSe, coeff, Fvalue
+
+
+def _degrees_of_freedom(n_subjects, n_raters, model):
+    """Return the degrees of freedom (df1, df2) of the F-test."""
+    df1 = n_subjects - 1
+    if model == 'oneway':
+        df2 = n_subjects * (n_raters - 1)
+    else:
+        df2 = (n_subjects - 1) * (n_raters - 1)
+    return df1, df2
 
 
 def icc(ratings, model='oneway', type='consistency', unit='single', confidence_level=0.95):
@@ -74,136 +341,122 @@ def icc(ratings, model='oneway', type='consistency', unit='single', confidence_l
         reliability. Psychological Bulletin, 86, 420-428.
         [4] -
     """
-    ratings = np.asarray(ratings)
-
-    if (model, type, unit) not in {('oneway', 'agreement', 'single'),
-                                   ('twoway', 'agreement', 'single'),
-                                   ('twoway', 'consistency', 'single'),
-                                   ('oneway', 'agreement', 'average'),
-                                   ('twoway', 'agreement', 'average'),
-                                   ('twoway', 'consistency', 'average'), }:
-        raise ValueError('Using not implemented configuration.')
+    _check_config(model, type, unit)
+    ratings = _as_ratings(ratings, 2)
 
+    # Serial kernels only, so that icc() does not start the parallel runtime of numba
+    # and stays safe to call from threads or forked processes.
     n_subjects, n_raters = ratings.shape
-    if n_subjects < 1:
-        raise ValueError('Using one subject only. Add more subjects to calculate ICC.')
+    return make_icc(n_subjects, n_raters, model, type, unit, confidence_level)(ratings)
+
+
+def icc_batch(ratings, model='oneway', type='consistency', unit='single', confidence_level=0.95):
+    """Compute the ICC of each ratings matrix of a stack, e.g. of bootstrap resamples.
+
+    All matrices are evaluated in a single call of a parallel jitted kernel, which
+    avoids the per-call overhead of `icc` in bootstrap or cross-validation loops.
+
+    Parameters
+    ----------
+    ratings: array-like, shape (n_batch, n_subjects, n_raters)
+        Stack of n_batch matrices with n subjects m raters
+    model, type, unit, confidence_level:
+        See `icc`.
+
+    Returns
+    -------
+    coeff: array, shape (n_batch,)
+        The intraclass correlation coefficients.
+    Fvalue: array, shape (n_batch,)
+        The values of the F-statistic.
+    df1: int
+        The numerator degrees of freedom, shared by all matrices.
+    df2: int
+        The denominator degrees of freedom, shared by all matrices.
+    pvalue: array, shape (n_batch,)
+        The p-values.
+    lbound: array, shape (n_batch,)
+        The lower bounds of the confidence intervals.
+    ubound: array, shape (n_batch,)
+        The upper bounds of the confidence intervals.
+    """
+    _check_config(model, type, unit)
+    ratings = _as_ratings(ratings, 3)
+    n_batch, n_subjects, n_raters = ratings.shape
 
-    SStotal = np.var(ratings, ddof=1) * (n_subjects * n_raters - 1)
     alpha = 1 - confidence_level
+    model_id, type_id, unit_id = _MODELS[model], _TYPES[type], _UNITS[unit]
 
-    MSr = np.var(np.mean(ratings, axis=1), ddof=1) * n_raters
-    MSw = np.sum(np.var(ratings, axis=1, ddof=1) / n_subjects)
-    MSc = np.var(np.mean(ratings, axis=0), ddof=1) * n_subjects
-    MSe = (SStotal - MSr * (n_subjects - 1) - MSc * (n_raters - 1)) / ((n_subjects - 1) * (n_raters - 1))
+    df1, df2 = _degrees_of_freedom(n_subjects, n_raters, model)
+    MSr, MSw, MSc, MSe, coeff, Fvalue = _icc_batch_kernel(ratings, model_id, type_id, unit_id)
+    pvalue = _f_sf(Fvalue, df1, df2)
 
-    # Single Score ICCs
-    if unit == 'single':
-        if model == 'oneway':
-            # ICC(1,1) One-Way Random, absolute
-            coeff = (MSr - MSw) / (MSr + (n_raters - 1) * MSw)
-            Fvalue = MSr / MSw
-            df1 = n_subjects - 1
-            df2 = n_subjects * (n_raters - 1)
-            pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-            # Confidence interval
-            FL = Fvalue / f.ppf(1 - alpha, df1, df2)
-            FU = Fvalue * f.ppf(1 - alpha, df2, df1)
-            lbound = (FL - 1) / (FL + (n_raters - 1))
-            ubound = (FU - 1) / (FU + (n_raters - 1))
-
-        elif model == 'twoway':
-            if type == 'agreement':
-                # ICC(2,1) Two-Way Random, absolute
-                coeff = (MSr - MSe) / (MSr + (n_raters - 1) * MSe + (n_raters / n_subjects) * (MSc - MSe))
-                Fvalue = MSr / MSe
-                df1 = n_subjects - 1
-                df2 = (n_subjects - 1) * (n_raters - 1)
-                pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-                # Confidence interval
-                Fj = MSc / MSe
-                vn = (n_raters - 1) * (n_subjects - 1) * (
-                    (n_raters * coeff * Fj + n_subjects * (1 + (n_raters - 1) * coeff) - n_raters * coeff)) ** 2
-                vd = (n_subjects - 1) * n_raters ** 2 * coeff ** 2 * Fj ** 2 + (
-                        n_subjects * (1 + (n_raters - 1) * coeff) - n_raters * coeff) ** 2
-                v = vn / vd
-
-                FL = f.ppf(1 - alpha, n_subjects - 1, v)
-                FU = f.ppf(1 - alpha, v, n_subjects - 1)
-                lbound = (n_subjects * (MSr - FL * MSe)) / (FL * (
-                        n_raters * MSc + (n_raters * n_subjects - n_raters - n_subjects) * MSe) + n_subjects * MSr)
-                ubound = (n_subjects * (FU * MSr - MSe)) / (n_raters * MSc + (
-                        n_raters * n_subjects - n_raters - n_subjects) * MSe + n_subjects * FU * MSr)
-
-            elif type == 'consistency':
-                # ICC(3,1) Two-Way Mixed, consistency
-                coeff = (MSr - MSe) / (MSr + (n_raters - 1) * MSe)
-                Fvalue = MSr / MSe
-                df1 = n_subjects - 1
-                df2 = (n_subjects - 1) * (n_raters - 1)
-                pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-                # Confidence interval
-                FL = Fvalue / f.ppf(1 - alpha, df1, df2)
-                FU = Fvalue * f.ppf(1 - alpha, df2, df1)
-                lbound = (FL - 1) / (FL + (n_raters - 1))
-                ubound = (FU - 1) / (FU + (n_raters - 1))
-
-    elif unit == 'average':
-        if model == 'oneway':
-            # ICC(1,k) One-Way Random, absolute
-            coeff = (MSr - MSw) / MSr
-            Fvalue = MSr / MSw
-            df1 = n_subjects - 1
-            df2 = n_subjects * (n_raters - 1)
-            pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-            # Confidence interval
-            FL = (MSr / MSw) / f.ppf(1 - alpha, df1, df2)
-            FU = (MSr / MSw) * f.ppf(1 - alpha, df2, df1)
-            lbound = 1 - 1 / FL
-            ubound = 1 - 1 / FU
-
-        elif model == 'twoway':
-            if type == 'agreement':
-                # ICC(2,k) Two-Way Random, absolute
-                coeff = (MSr - MSe) / (MSr + (MSc - MSe) / n_subjects)
-                Fvalue = MSr / MSe
-                df1 = n_subjects - 1
-                df2 = (n_subjects - 1) * (n_raters - 1)
-                pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-                # Confidence interval
-                icc2 = (MSr - MSe) / (MSr + (n_raters - 1) * MSe + (n_raters / n_subjects) * (MSc - MSe))
-                Fj = MSc / MSe
-                vn = (n_raters - 1) * (n_subjects - 1) * (
-                    (n_raters * icc2 * Fj + n_subjects * (1 + (n_raters - 1) * icc2) - n_raters * icc2)) ** 2
-                vd = (n_subjects - 1) * n_raters ** 2 * icc2 ** 2 * Fj ** 2 + (
-                        n_subjects * (1 + (n_raters - 1) * icc2) - n_raters * icc2) ** 2
-                v = vn / vd
-
-                FL = f.ppf(1 - alpha, n_subjects - 1, v)
-                FU = f.ppf(1 - alpha, v, n_subjects - 1)
-                lb2 = (n_subjects * (MSr - FL * MSe)) / (FL * (
-                        n_raters * MSc + (n_raters * n_subjects - n_raters - n_subjects) * MSe) + n_subjects * MSr)
-                ub2 = (n_subjects * (FU * MSr - MSe)) / (n_raters * MSc + (
-                        n_raters * n_subjects - n_raters - n_subjects) * MSe + n_subjects * FU * MSr)
-                lbound = lb2 * n_raters / (1 + lb2 * (n_raters - 1))
-                ubound = ub2 * n_raters / (1 + ub2 * (n_raters - 1))
-
-            elif type == 'consistency':
-                # ICC(3,k) Two-Way Mixed, consistency
-                coeff = (MSr - MSe) / MSr
-                Fvalue = MSr / MSe
-                df1 = n_subjects - 1
-                df2 = (n_subjects - 1) * (n_raters - 1)
-                pvalue = 1 - f.cdf(Fvalue, df1, df2)
-
-                # Confidence interval
-                FL = Fvalue / f.ppf(1 - alpha, df1, df2)
-                FU = Fvalue * f.ppf(1 - alpha, df2, df1)
-                lbound = 1 - 1 / FL
-                ubound = 1 - 1 / FU
+    # Confidence interval
+    v = df2
+    if model == 'twoway' and type == 'agreement':
+        v = _icc_agreement_df(MSr, MSc, MSe, n_subjects, n_raters)
+    FL_crit = _f_ppf(1 - alpha, df1, v)
+    FU_crit = _f_ppf(1 - alpha, v, df1)
+    lbound, ubound = _icc_bounds(MSr, MSw, MSc, MSe, n_subjects, n_raters,
+                                 model_id, type_id, unit_id, Fvalue, FL_crit, FU_crit)
 
     return coeff, Fvalue, df1, df2, pvalue, lbound, ubound
+
+
+def make_icc(n_subjects, n_raters, model='oneway', type='consistency', unit='single', confidence_level=0.95):
+    """Create an ICC function specialised to a fixed shape and configuration.
+
+    The degrees of freedom only depend on the shape of the ratings, so the F
+    quantiles of the confidence interval are computed once here instead of in every
+    call, e.g. of a bootstrap or permutation loop. For the agreement ICCs the
+    denominator degrees of freedom of the interval are approximated from the data,
+    so their quantiles are still computed in each call.
+
+    Parameters
+    ----------
+    n_subjects: int
+        Number of subjects of the ratings.
+    n_raters: int
+        Number of raters of the ratings.
+    model, type, unit, confidence_level:
+        See `icc`.
+
+    Returns
+    -------
+    run: callable
+        Function taking ratings of shape (n_subjects, n_raters) and returning the
+        same values as `icc`.
+    """
+    _check_config(model, type, unit)
+    _check_shape(n_subjects, n_raters)
+
+    alpha = 1 - confidence_level
+    model_id, type_id, unit_id = _MODELS[model], _TYPES[type], _UNITS[unit]
+    agreement = model == 'twoway' and type == 'agreement'
+
+    df1, df2 = _degrees_of_freedom(n_subjects, n_raters, model)
+    if not agreement:
+        FL_crit = _f_ppf(1 - alpha, df1, df2)
+        FU_crit = _f_ppf(1 - alpha, df2, df1)
+
+    def run(ratings):
+        ratings = _as_ratings(ratings, 2)
+        if ratings.shape != (n_subjects, n_raters):
+            raise ValueError('Expected ratings of shape {}, got {}.'.format((n_subjects, n_raters), ratings.shape))
+
+        MSr, MSw, MSc, MSe = _icc_moments(ratings)
+        coeff, Fvalue = _icc_stats(MSr, MSw, MSc, MSe, n_subjects, n_raters, model_id, type_id, unit_id)
+        pvalue = _f_sf(Fvalue, df1, df2)
+
+        # Confidence interval
+        if agreement:
+            v = _icc_agreement_df(MSr, MSc, MSe, n_subjects, n_raters)
+            FL, FU = _f_ppf(1 - alpha, df1, v), _f_ppf(1 - alpha, v, df1)
+        else:
+            FL, FU = FL_crit, FU_crit
+        lbound, ubound = _icc_bounds(MSr, MSw, MSc, MSe, n_subjects, n_raters,
+                                     model_id, type_id, unit_id, Fvalue, FL, FU)
+
+        return coeff, Fvalue, df1, df2, pvalue, lbound, ubound
+
+    return run
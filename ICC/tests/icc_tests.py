@@ -1,9 +1,13 @@
 """Unit tests for confound_standardization/confound_module.py."""
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pytest
 from pytest import approx
+from scipy.stats import f
 
-from ICC import icc
+from ICC import icc, icc_batch, make_icc
+from ICC.icc import _f_ppf, _f_ppf_cached, _f_sf, _icc_moments
 
 
 def test_not_implemented_config():
@@ -20,6 +24,36 @@ def test_one_subject_input():
         icc(ratings, model='oneway', type='agreement', unit='single')
 
 
+def test_one_rater_input():
+    """Test raise error when using an input with only one rater."""
+    ratings = np.array([[4], [2], [3]])
+    with pytest.raises(ValueError):
+        icc(ratings, model='oneway', type='agreement', unit='single')
+
+
+def test_three_dimensional_input():
+    """Test raise error when using a stack of matrices in icc."""
+    ratings = np.ones((2, 5, 3))
+    with pytest.raises(ValueError):
+        icc(ratings, model='oneway', type='agreement', unit='single')
+
+
+def test_input_conversion():
+    """Test lists, float32 arrays and non-contiguous views give the same values as float64 arrays."""
+    rng = np.random.RandomState(42)
+    big = rng.normal(size=(10, 8))
+    ratings = np.ascontiguousarray(big[:, ::2])
+    expected = icc(ratings, model='twoway', type='agreement', unit='single')
+
+    for converted in [ratings.tolist(), big[:, ::2]]:
+        assert expected == approx(icc(converted, model='twoway', type='agreement', unit='single'))
+
+    ratings_float32 = ratings.astype(np.float32)
+    expected_float32 = icc(ratings_float32.astype(np.float64), model='twoway', type='agreement', unit='single')
+    assert expected_float32 == approx(icc(ratings_float32, model='twoway', type='agreement', unit='single'))
+    assert expected == approx(icc(ratings_float32, model='twoway', type='agreement', unit='single'), rel=1e-5)
+
+
 def test_icc_1_1_with_shrout_values():
     """Test ICC(1,1) with values from [1] ([2] and [3] are example in R and SPSS).
 
@@ -223,3 +257,168 @@ def test_with_koo_and_li_values_case_1():
     # Two-Way Mixed, absolute [ICC(3,k)]= 1.00
     coeff, _, _, _, _, _, _ = icc(ratings, model='twoway', type='consistency', unit='average')
     assert 1.00 == approx(coeff, abs=1e-2)
+
+    # Identical raters have no within-subject variance, so the F-test is infinitely significant
+    for model, type, unit in [('oneway', 'agreement', 'single'),
+                              ('twoway', 'agreement', 'single'),
+                              ('twoway', 'consistency', 'single'),
+                              ('oneway', 'agreement', 'average'),
+                              ('twoway', 'agreement', 'average'),
+                              ('twoway', 'consistency', 'average')]:
+        _, Fvalue, _, _, pvalue, _, _ = icc(ratings, model=model, type=type, unit=unit)
+        assert Fvalue == np.inf
+        assert pvalue == 0
+
+
+def test_constant_ratings():
+    """Test the ICC and the F-test are undefined when all ratings are equal."""
+    ratings = np.ones((5, 3))
+
+    for model, type, unit in [('oneway', 'agreement', 'single'),
+                              ('twoway', 'agreement', 'single'),
+                              ('twoway', 'consistency', 'single'),
+                              ('oneway', 'agreement', 'average'),
+                              ('twoway', 'agreement', 'average'),
+                              ('twoway', 'consistency', 'average')]:
+        coeff, Fvalue, _, _, pvalue, lbound, ubound = icc(ratings, model=model, type=type, unit=unit)
+        assert np.isnan(coeff)
+        assert np.isnan(Fvalue)
+        assert np.isnan(pvalue)
+        assert np.isnan(lbound)
+        assert np.isnan(ubound)
+
+
+def test_icc_batch_with_shrout_values():
+    """Test icc_batch on a stack of row and column permutations of the data from [1].
+
+    References
+    ----------
+    [1] - Shrout, Patrick E., and Joseph L. Fleiss. "Intraclass correlations: uses in assessing rater reliability."
+     Psychological bulletin 86.2 (1979): 420.
+    """
+    ratings = np.array([[9., 2., 5., 8.],
+                        [6., 1., 3., 2.],
+                        [8., 4., 6., 8.],
+                        [7., 1., 2., 6.],
+                        [10., 5., 6., 9.],
+                        [6., 2., 4., 7.]])
+    rng = np.random.RandomState(42)
+    ratings_stack = np.stack([ratings[rng.permutation(6)][:, rng.permutation(4)] for _ in range(5)])
+
+    # ICC(2,1)
+    coeff, Fvalue, df1, df2, pvalue, lbound, ubound = icc_batch(ratings_stack, model='twoway', type='agreement',
+                                                                unit='single')
+    assert coeff.shape == (5,)
+    assert 0.2897638 == approx(coeff, abs=1e-3)
+    assert 11.027248 == approx(Fvalue, abs=1e-3)
+    assert df1 == 5
+    assert df2 == 15
+    assert 0.0001345665 == approx(pvalue, abs=1e-3)
+    assert 0.04290119 == approx(lbound, abs=1e-3)
+    assert 0.6910706 == approx(ubound, abs=1e-3)
+
+    # ICC(3,k)
+    coeff, Fvalue, df1, df2, pvalue, lbound, ubound = icc_batch(ratings_stack, model='twoway', type='consistency',
+                                                                unit='average')
+    assert 0.9093155 == approx(coeff, abs=1e-3)
+    assert 11.027248 == approx(Fvalue, abs=1e-3)
+    assert df1 == 5
+    assert df2 == 15
+    assert 0.0001345665 == approx(pvalue, abs=1e-3)
+    assert 0.73689768 == approx(lbound, abs=1e-3)
+    assert 0.9803661 == approx(ubound, abs=1e-3)
+
+
+def test_make_icc_matches_icc():
+    """Test the function returned by make_icc gives the same values as icc."""
+    ratings = np.array([[9., 2., 5., 8.],
+                        [6., 1., 3., 2.],
+                        [8., 4., 6., 8.],
+                        [7., 1., 2., 6.],
+                        [10., 5., 6., 9.],
+                        [6., 2., 4., 7.]])
+
+    for model, type, unit in [('oneway', 'agreement', 'single'),
+                              ('twoway', 'agreement', 'single'),
+                              ('twoway', 'consistency', 'single'),
+                              ('oneway', 'agreement', 'average'),
+                              ('twoway', 'agreement', 'average'),
+                              ('twoway', 'consistency', 'average')]:
+        run = make_icc(6, 4, model=model, type=type, unit=unit)
+        expected = icc(ratings, model=model, type=type, unit=unit)
+        assert expected == approx(run(ratings))
+
+
+def test_make_icc_wrong_shape():
+    """Test raise error when using ratings of a different shape than make_icc was created for."""
+    run = make_icc(6, 4, model='oneway', type='agreement', unit='single')
+    with pytest.raises(ValueError):
+        run(np.ones((5, 4)))
+
+
+def test_icc_moments_with_anova_definitions():
+    """Test the single pass mean squares against their definitions from the variances of the ratings."""
+    rng = np.random.RandomState(42)
+    ratings = rng.normal(loc=100., size=(12, 5))
+    n_subjects, n_raters = ratings.shape
+
+    SStotal = np.var(ratings, ddof=1) * (n_subjects * n_raters - 1)
+    MSr = np.var(np.mean(ratings, axis=1), ddof=1) * n_raters
+    MSw = np.sum(np.var(ratings, axis=1, ddof=1) / n_subjects)
+    MSc = np.var(np.mean(ratings, axis=0), ddof=1) * n_subjects
+    MSe = (SStotal - MSr * (n_subjects - 1) - MSc * (n_raters - 1)) / ((n_subjects - 1) * (n_raters - 1))
+
+    assert (MSr, MSw, MSc, MSe) == approx(_icc_moments(ratings))
+
+
+def test_f_distribution_with_scipy_values():
+    """Test the incomplete beta forms of the F distribution against scipy.stats.f."""
+    for dfn, dfd in [(5, 15), (5, 18), (5, 14.3), (14.3, 5), (2.5, 7.75), (4, 0.01), (4, 0.16), (4, 0.3), (1, 0.1)]:
+        for x in [0.1, 1., 2.5, 11.027248, 1e4]:
+            assert f.sf(x, dfn, dfd) == approx(_f_sf(x, dfn, dfd), rel=1e-10)
+        for q in [0.05, 0.5, 0.95, 0.999]:
+            assert f.ppf(q, dfn, dfd) == approx(_f_ppf(q, dfn, dfd), rel=1e-10)
+
+    # Very small p-values
+    assert 1e-26 < f.sf(1e4, 5, 15) < 1e-19
+    assert f.sf(1e4, 5, 15) == approx(_f_sf(1e4, 5, 15), rel=1e-10)
+    assert f.sf(1e3, 5, 14.3) == approx(_f_sf(1e3, 5, 14.3), rel=1e-10)
+
+    # Array arguments, as used by icc_batch
+    x = np.array([0.5, 2., 1e3])
+    dfd = np.array([14.3, 15., 20.5])
+    assert f.sf(x, 5, dfd) == approx(_f_sf(x, 5, dfd), rel=1e-10)
+    assert f.ppf(0.95, 5, dfd) == approx(_f_ppf(0.95, 5, dfd), rel=1e-10)
+    dfd = np.array([0.013, 0.1, 0.16])
+    assert f.ppf(0.95, 4, dfd) == approx(_f_ppf(0.95, 4, dfd), rel=1e-10)
+
+    assert _f_sf(np.inf, 5, 15) == 0
+    assert _f_sf(0., 5, 15) == 1
+
+    # Degrees of freedom outside the support, as for a vanishing agreement df
+    assert np.isnan(_f_ppf(0.95, 4, 0.))
+    assert np.isnan(_f_sf(2., 4, 0.))
+
+
+def test_icc_from_threads():
+    """Test icc can be called concurrently from several threads."""
+    rng = np.random.RandomState(42)
+    ratings_stack = rng.normal(size=(64, 10, 4))
+    expected = [icc(ratings, model='twoway', type='agreement', unit='single') for ratings in ratings_stack]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda ratings: icc(ratings, model='twoway', type='agreement', unit='single'),
+                                    ratings_stack))
+
+    for expected_values, values in zip(expected, results):
+        assert expected_values == approx(values)
+
+
+def test_icc_reuses_f_quantiles():
+    """Test repeated icc calls on the same data hit the cache of the F quantiles."""
+    ratings = np.random.RandomState(42).normal(size=(10, 4))
+
+    icc(ratings, model='twoway', type='agreement', unit='single')
+    hits = _f_ppf_cached.cache_info().hits
+    icc(ratings, model='twoway', type='agreement', unit='single')
+    assert _f_ppf_cached.cache_info().hits == hits + 2
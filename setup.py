@@ -36,5 +36,5 @@ setup(
     ],
     packages=['icc'],
     include_package_data=True,
-    install_requires=['scipy', 'numpy'],
+    install_requires=['scipy', 'numpy', 'numba'],
 )